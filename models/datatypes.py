@@ -22,6 +22,10 @@ class SamplingStrategy(Enum):
 
 @json_schema_type
 class SamplingParams(BaseModel):
+    # frozen so that a single instance can be shared, e.g. as the recommended
+    # params of every registered model
+    model_config = ConfigDict(frozen=True)
+
     strategy: SamplingStrategy = SamplingStrategy.greedy
 
     temperature: Optional[float] = 0.0
@@ -13,7 +13,7 @@ from unittest import TestCase
 
 from .chat_format import ChatFormat
 from .datatypes import SystemMessage, UserMessage
-from .tokenizer import Tokenizer
+from .tokenizer import StreamingDetokenizer, Tokenizer
 
 
 # TOKENIZER_PATH=<tokenizer_path> python -m unittest models/llama3/api/test_tokenizer.py
@@ -44,6 +44,19 @@ class TokenizerTests(TestCase):
             "<|begin_of_text|>This is a test sentence.<|end_of_text|>",
         )
 
+    def test_streaming_detokenizer(self):
+        text = "Caf\u00e9 \U0001f999 is open.<|eot_id|>"
+        tokens = self.tokenizer.encode(
+            text, bos=False, eos=False, allowed_special="all"
+        )
+        detokenizer = StreamingDetokenizer(self.tokenizer)
+        pieces = [detokenizer.step(t) for t in tokens]
+        self.assertEqual("".join(pieces) + detokenizer.flush(), text)
+        self.assertEqual(pieces[-1], "<|eot_id|>")
+        self.assertNotIn("\ufffd", "".join(pieces))
+        # the llama emoji is split over three byte-level tokens
+        self.assertIn("\U0001f999", pieces)
+
     def test_encode_message(self):
         message = UserMessage(
             content="This is a test sentence.",
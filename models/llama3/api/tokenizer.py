@@ -8,6 +8,7 @@
 # Copyright (c) Meta Platforms, Inc. and affiliates.
 # This software may be used and distributed in accordance with the terms of the Llama 3 Community License Agreement.
 
+import codecs
 import os
 from logging import getLogger
 from pathlib import Path
@@ -212,3 +213,36 @@ class Tokenizer:
                     slice_start = i
                     current_slice_len = 1
         yield s[slice_start:]
+
+
+class StreamingDetokenizer:
+    """
+    Incrementally decodes a stream of token IDs, one token at a time.
+
+    Decoding each new token on its own with `Tokenizer.decode` cannot handle UTF-8
+    characters whose bytes are split across tokens. This keeps the undecoded tail
+    between calls and only emits text once it is complete, so the concatenated
+    output equals `Tokenizer.decode` of the whole sequence.
+    """
+
+    def __init__(self, tokenizer: Tokenizer):
+        self.tokenizer = tokenizer
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def step(self, token: int) -> str:
+        """
+        Feeds one token ID and returns the text that became complete with it.
+
+        Args:
+            token (int): The next token ID.
+
+        Returns:
+            str: Newly decodable text, possibly empty.
+        """
+        return self._decoder.decode(
+            self.tokenizer.model.decode_single_token_bytes(token)
+        )
+
+    def flush(self) -> str:
+        """Returns any pending incomplete bytes, decoded with replacement characters."""
+        return self._decoder.decode(b"", final=True)
@@ -18,24 +18,58 @@ import json
 import os
 import sys
 import time
+from contextlib import contextmanager
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Generator, List, Optional
+from typing import Callable, Dict, Generator, List, Optional, Tuple
 
 import torch
-import torch.nn.functional as F
 from fairscale.nn.model_parallel.initialize import (
     get_model_parallel_rank,
     initialize_model_parallel,
     model_parallel_is_initialized,
 )
+from fairscale.nn.model_parallel.layers import ColumnParallelLinear, RowParallelLinear
 from termcolor import cprint
+from torch import nn
+
+try:
+    from flashinfer.sampling import top_k_top_p_sampling_from_logits
+except ImportError:
+    top_k_top_p_sampling_from_logits = None
+
+try:
+    from safetensors import safe_open
+except ImportError:
+    safe_open = None
+
+try:
+    from verl.utils.kernel.linear_cross_entropy import linear_cross_entropy
+except ImportError:
+    linear_cross_entropy = None
 
 from ..api.args import ModelArgs
 from ..api.chat_format import ChatFormat, ModelInput
 from ..api.datatypes import CompletionMessage, Message, StopReason, ToolPromptFormat
-from ..api.tokenizer import Tokenizer
-from .model import Transformer
+from ..api.tokenizer import StreamingDetokenizer, Tokenizer
+from .model import model_parallel_world_size, Transformer
+
+# Number of highest-probability candidates considered by top-p sampling. The
+# nucleus for typical top_p values sits well inside this, and it replaces a
+# sort over the full vocabulary with a much cheaper top-k.
+TOP_K_PREFILTER = 1024
+
+# Number of decode steps between copies of the generated tokens back to the host.
+# Reading tokens on the host forces a device sync, so `generate` batches it and
+# yields the tokens of each chunk together.
+STREAM_INTERVAL = 8
+
+# Fraction of the device memory left free after loading the weights that `build`
+# hands to the paged KV cache.
+KV_CACHE_MEMORY_FRACTION = 0.8
+
+# Longest trailing n-gram that prompt-lookup decoding searches for in the context.
+PROMPT_LOOKUP_MAX_NGRAM = 3
 
 
 @dataclass
@@ -68,6 +102,9 @@ class Llama:
         max_batch_size: int,
         model_parallel_size: Optional[int] = None,
         seed: int = 1,
+        compile: bool = True,
+        quantization: Optional[str] = None,
+        speculative_tokens: int = 0,
     ):
         """
         Build a Llama instance by initializing and loading a model checkpoint.
@@ -79,6 +116,14 @@ class Llama:
             max_batch_size (int): Maximum batch size for inference.
             model_parallel_size (Optional[int], optional): Number of model parallel processes.
                 If not provided, it's determined from the environment. Defaults to None.
+            compile (bool, optional): Whether to compile the single-token decode step with
+                torch.compile. Defaults to True.
+            quantization (Optional[str], optional): Weight-only quantization applied to the
+                linear layers after loading, either "int8" or "fp8". Requires `torchao`.
+                Defaults to None.
+            speculative_tokens (int, optional): Number of prompt-lookup draft tokens
+                verified per forward pass during greedy decoding. 0 disables speculative
+                decoding. Defaults to 0.
 
         Returns:
             Llama: An instance of the Llama class with the loaded model and tokenizer.
@@ -89,35 +134,48 @@ class Llama:
 
 
         Note:
-            This method initializes the distributed process group, sets the device to CUDA,
-            and loads the pre-trained model and tokenizer.
+            When model_parallel_size > 1, this method initializes the distributed process
+            group. It sets the device to CUDA and loads the pre-trained model and tokenizer.
         """
 
-        if not torch.distributed.is_initialized():
-            torch.distributed.init_process_group("nccl")
+        if model_parallel_size is None:
+            model_parallel_size = int(os.environ.get("WORLD_SIZE", 1))
 
-        if not model_parallel_is_initialized():
-            if model_parallel_size is None:
-                model_parallel_size = int(os.environ.get("WORLD_SIZE", 1))
-            initialize_model_parallel(model_parallel_size)
+        # a single process needs no process groups; the model then uses plain torch
+        # layers instead of fairscale's model-parallel ones
+        if model_parallel_size > 1:
+            if not torch.distributed.is_initialized():
+                torch.distributed.init_process_group("nccl")
+
+            if not model_parallel_is_initialized():
+                initialize_model_parallel(model_parallel_size)
 
         local_rank = int(os.environ.get("LOCAL_RANK", 0))
         torch.cuda.set_device(local_rank)
 
         torch.manual_seed(seed)
 
-        if local_rank > 0:
+        # silence non-zero ranks once; later builds in the same process (or a caller
+        # that already redirected stdout) keep the current stream
+        if local_rank > 0 and sys.stdout is sys.__stdout__:
             sys.stdout = open(os.devnull, "w")
 
         start_time = time.time()
 
-        checkpoints = sorted(Path(ckpt_dir).glob("*.pth"))
+        # checkpoints converted to safetensors are preferred; they load straight to
+        # the GPU without staging the whole shard in host memory
+        checkpoints = []
+        if safe_open is not None:
+            checkpoints = sorted(Path(ckpt_dir).glob("*.safetensors"))
+        if not checkpoints:
+            checkpoints = sorted(Path(ckpt_dir).glob("*.pth"))
         assert len(checkpoints) > 0, f"no checkpoint files found in {ckpt_dir}"
         assert model_parallel_size == len(
             checkpoints
         ), f"Loading a checkpoint for MP={len(checkpoints)} but world size is {model_parallel_size}"
-        ckpt_path = checkpoints[get_model_parallel_rank()]
-        checkpoint = torch.load(ckpt_path, map_location="cpu", weights_only=True)
+        ckpt_path = checkpoints[
+            get_model_parallel_rank() if model_parallel_size > 1 else 0
+        ]
         with open(Path(ckpt_dir) / "params.json", "r") as f:
             params = json.loads(f.read())
 
@@ -129,20 +187,98 @@ class Llama:
         tokenizer = Tokenizer(model_path=tokenizer_path)
         assert model_args.vocab_size == tokenizer.n_words
         if torch.cuda.is_bf16_supported():
-            torch.set_default_tensor_type(torch.cuda.BFloat16Tensor)
+            dtype = torch.bfloat16
         else:
-            torch.set_default_tensor_type(torch.cuda.HalfTensor)
-        model = Transformer(model_args)
-        model.load_state_dict(checkpoint, strict=False)
+            dtype = torch.float16
+        with torch.device("cuda"), default_dtype(dtype):
+            model = Transformer(model_args)
+        # fairscale's layers allocate through the legacy torch.Tensor constructor,
+        # which ignores the device context
+        model.to(device="cuda")
+        load_weights(model, ckpt_path, device=f"cuda:{local_rank}")
+
+        if quantization is not None:
+            quantize_weights(model, quantization)
+            # hand the memory of the replaced full-precision weights to the KV cache
+            torch.cuda.empty_cache()
+
+        # size the paged KV cache from the memory left after loading the weights,
+        # capped at what max_batch_size full-length sequences could ever use
+        free_bytes, _ = torch.cuda.mem_get_info()
+        num_blocks = min(
+            int(free_bytes * KV_CACHE_MEMORY_FRACTION) // model.kv_cache_block_bytes(),
+            model_args.max_batch_size * model.max_blocks_per_seq + 1,
+        )
+        # fail here rather than part-way through generating a valid prompt
+        assert num_blocks > model.max_blocks_per_seq, (
+            f"Only {num_blocks} KV cache blocks fit in memory, but a sequence of "
+            f"max_seq_len={max_seq_len} needs {model.max_blocks_per_seq + 1}"
+        )
+        model.setup_kv_cache(num_blocks)
         print(f"Loaded in {time.time() - start_time:.2f} seconds")
 
-        return Llama(model, tokenizer, model_args)
+        return Llama(
+            model,
+            tokenizer,
+            model_args,
+            compile=compile,
+            speculative_tokens=speculative_tokens,
+        )
 
-    def __init__(self, model: Transformer, tokenizer: Tokenizer, args: ModelArgs):
+    def __init__(
+        self,
+        model: Transformer,
+        tokenizer: Tokenizer,
+        args: ModelArgs,
+        compile: bool = False,
+        draft_model: Optional[Transformer] = None,
+        speculative_tokens: int = 0,
+    ):
         self.args = args
         self.model = model
         self.tokenizer = tokenizer
         self.formatter = ChatFormat(tokenizer)
+        # the stop check runs on the host for every generated token
+        self._stop_tokens_set = frozenset(tokenizer.stop_tokens)
+        if model.kv_allocator is None:
+            model.setup_kv_cache()
+
+        # Greedy decoding verifies `speculative_tokens` draft tokens per forward of
+        # the model, proposed by `draft_model` or, without one, by prompt lookup.
+        assert draft_model is None or speculative_tokens > 0
+        self.draft_model = draft_model
+        self.speculative_tokens = speculative_tokens
+        if draft_model is not None:
+            assert draft_model.vocab_size == model.vocab_size
+            if draft_model.kv_allocator is None:
+                draft_model.setup_kv_cache()
+        # number of leading positions held in the draft model's KV cache
+        self._draft_pos = 0
+
+        # The decode step always sees (bsz, 1) tokens and a 1-element position
+        # tensor, so it compiles to a single static graph. CUDA graphs are not
+        # enabled in torch.compile because DecodeGraph captures the compiled step
+        # together with sampling. Prefill keeps using the eager forward. fairscale's
+        # collectives cannot be traced, so a graph break is allowed around them
+        # with model parallelism.
+        self.decode_step = model.forward_decode
+        if compile:
+            self.decode_step = torch.compile(
+                model.forward_decode,
+                fullgraph=model_parallel_world_size() == 1,
+                dynamic=False,
+            )
+        self._decode_graphs: Dict[Tuple[int, bool, bool], DecodeGraph] = {}
+
+        # allocated on the first generate call that asks for logprobs and reused after
+        self._token_logprobs: Optional[torch.Tensor] = None
+        self._score_stream: Optional[torch.cuda.Stream] = None
+
+        # pinned host staging for prompt tokens and the stream that uploads them,
+        # allocated on the first generate call and reused after
+        self._prompt_staging: Optional[torch.Tensor] = None
+        self._copy_stream: Optional[torch.cuda.Stream] = None
+        self._prompt_uploaded: Optional[torch.cuda.Event] = None
 
     @torch.inference_mode()
     def generate(
@@ -156,83 +292,254 @@ class Llama:
         params = self.model.params
 
         # cprint("Input to model -> " + self.tokenizer.decode(model_input.tokens), "red")
-        prompt_tokens = [model_input.tokens]
+        prompt_tokens = model_input.tokens
 
+        # a single prompt is always fully known before generation starts, so
+        # every position from prompt_len on is generated
         bsz = 1
         assert bsz <= params.max_batch_size, (bsz, params.max_batch_size)
 
-        min_prompt_len = min(len(t) for t in prompt_tokens)
-        max_prompt_len = max(len(t) for t in prompt_tokens)
+        prompt_len = len(prompt_tokens)
 
-        if max_prompt_len >= params.max_seq_len:
-            cprint(
-                f"Out of token budget {max_prompt_len} vs {params.max_seq_len}", "red"
-            )
+        if prompt_len >= params.max_seq_len:
+            cprint(f"Out of token budget {prompt_len} vs {params.max_seq_len}", "red")
             return
 
-        total_len = min(max_gen_len + max_prompt_len, params.max_seq_len)
+        total_len = min(max_gen_len + prompt_len, params.max_seq_len)
         pad_id = self.tokenizer.pad_id
         tokens = torch.full((bsz, total_len), pad_id, dtype=torch.long, device="cuda")
-        for k, t in enumerate(prompt_tokens):
-            tokens[k, : len(t)] = torch.tensor(t, dtype=torch.long, device="cuda")
+        self._upload_prompt(tokens[0, :prompt_len], prompt_tokens)
         if logprobs:
-            token_logprobs = torch.zeros_like(tokens, dtype=torch.float)
-
-        prev_pos = 0
-        eos_reached = torch.tensor([False] * bsz, device="cuda")
-        input_text_mask = tokens != pad_id
-        if min_prompt_len == total_len:
-            logits = self.model.forward(tokens, prev_pos)
-            token_logprobs = -F.cross_entropy(
-                input=logits.transpose(1, 2),
-                target=tokens,
-                reduction="none",
-                ignore_index=pad_id,
-            )
-
-        stop_tokens = torch.tensor(self.tokenizer.stop_tokens)
+            if self._token_logprobs is None:
+                self._token_logprobs = torch.zeros(
+                    (params.max_batch_size, params.max_seq_len),
+                    dtype=torch.float,
+                    device="cuda",
+                )
+                self._score_stream = torch.cuda.Stream()
+            # every position that gets reported is written below, so the reused
+            # storage does not need to be cleared
+            token_logprobs = self._token_logprobs[:bsz, :total_len]
+
+        # KV cache blocks are reserved as the sequence grows (`forward` does so for
+        # the prompt) and handed back to the pool once generation finishes or the
+        # caller stops consuming tokens
+        allocator = self.model.kv_allocator
+        prompt_scored = None
+        try:
+            prev_pos = 0
+            detokenizer = StreamingDetokenizer(self.tokenizer)
+
+            # prefill: run the prompt once to populate the KV cache.
+            # Only the last position needs logits for sampling; the prompt positions are
+            # scored directly from the hidden states when logprobs are requested.
+            h = self.model.forward(tokens[:, :prompt_len], 0, return_hidden=True)
+            logits = self.model.output(h[:, -1]).float()
+            if logprobs:
+                # the prompt logprobs are first read when the first chunk is flushed,
+                # so they are computed on a side stream next to the first decode steps
+                self._score_stream.wait_stream(torch.cuda.current_stream())
+                with torch.cuda.stream(self._score_stream):
+                    token_logprobs[:, 1:prompt_len] = prompt_logprobs(
+                        self.model, h[:, :-1], tokens[:, 1:prompt_len], pad_id
+                    )
+                h.record_stream(self._score_stream)
+                prompt_scored = self._score_stream.record_event()
+
+            greedy = temperature <= 0
+            speculative = greedy and self.speculative_tokens > 0
+            if speculative:
+                lookup = None
+                if self.draft_model is None:
+                    lookup = PromptLookup()
+                    lookup.extend(prompt_tokens)
+                self._draft_pos = 0
+            else:
+                decode = self._decode_graph(bsz, greedy, logprobs)
+                decode.pos.fill_(prompt_len)
+                if not greedy:
+                    decode.temperature.fill_(temperature)
+                    decode.top_p.fill_(top_p)
+
+            cur_pos = prompt_len
+            while cur_pos < total_len:
+                # each iteration generates tokens[:, cur_pos : cur_pos + n]
+                n = 1
+                if cur_pos == prompt_len:
+                    next_token = sample(logits, temperature, top_p, greedy)
+                    if logprobs:
+                        next_logprob = token_logprob(logits, next_token)
+                elif speculative:
+                    n, step_logits = self._speculative_step(
+                        tokens, lookup, cur_pos, total_len
+                    )
+                else:
+                    # decode: the KV cache holds everything before cur_pos - 1, so only
+                    # the most recent token needs to go through the model
+                    allocator.reserve(0, cur_pos)
+                    decode.token.copy_(tokens[:, cur_pos - 1 : cur_pos])
+                    next_token, next_logprob = decode.run()
+                    decode.pos += 1
+
+                if speculative and cur_pos > prompt_len:
+                    if logprobs:
+                        token_logprobs[:, cur_pos : cur_pos + n] = token_logprob(
+                            step_logits, tokens[0, cur_pos : cur_pos + n]
+                        )
+                else:
+                    tokens[:, cur_pos] = next_token
+                    if logprobs:
+                        token_logprobs[:, cur_pos] = next_logprob
+                cur_pos += n
+
+                # speculative steps already sync to count the accepted tokens, so
+                # they are flushed right away. The first token is flushed on its own
+                # so streaming callers do not wait a whole chunk for it.
+                first_pos = max(prev_pos + 1, prompt_len)
+                if (
+                    not speculative
+                    and cur_pos > prompt_len + 1
+                    and cur_pos - first_pos < STREAM_INTERVAL
+                    and cur_pos < total_len
+                ):
+                    continue
+
+                # a single device sync per chunk of generated tokens
+                new_tokens = tokens[0, first_pos:cur_pos].tolist()
+                if speculative and lookup is not None:
+                    lookup.extend(new_tokens)
+                if logprobs:
+                    # the first token also reports the logprobs of the prompt
+                    if prev_pos == 0:
+                        torch.cuda.current_stream().wait_event(prompt_scored)
+                    lp_offset = prev_pos + 1
+                    new_logprobs = token_logprobs[0, lp_offset:cur_pos].tolist()
+                for pos, token in enumerate(new_tokens, start=first_pos):
+                    stop = token in self._stop_tokens_set
+                    text = detokenizer.step(token)
+                    if stop or pos == total_len - 1:
+                        # nothing is decoded after this token, so emit incomplete
+                        # trailing bytes instead of dropping them
+                        text += detokenizer.flush()
+                    yield TokenResult(
+                        token=token,
+                        text=text,
+                        logprobs=(
+                            new_logprobs[prev_pos + 1 - lp_offset : pos + 1 - lp_offset]
+                            if logprobs
+                            else None
+                        ),
+                    )
+                    prev_pos = pos
+                    if stop:
+                        return
+        finally:
+            if prompt_scored is not None:
+                # the next call reuses token_logprobs on the current stream, which
+                # may not have waited for the scoring if generation stopped early
+                torch.cuda.current_stream().wait_event(prompt_scored)
+            allocator.free(0)
+            if self.draft_model is not None:
+                self.draft_model.kv_allocator.free(0)
+
+    def _speculative_step(
+        self,
+        tokens: torch.Tensor,
+        lookup: Optional["PromptLookup"],
+        cur_pos: int,
+        total_len: int,
+    ) -> Tuple[int, torch.Tensor]:
+        """
+        Greedily generate tokens[:, cur_pos : cur_pos + n] with a single forward pass.
 
-        for cur_pos in range(min_prompt_len, total_len):
-            logits = self.model.forward(tokens[:, prev_pos:cur_pos], prev_pos)
+        Up to `speculative_tokens` draft tokens are proposed for the positions from
+        cur_pos on and checked in parallel against the model's own greedy choices.
+        The longest matching prefix is kept together with the model's token after it,
+        so each step makes at least the progress of a plain decode step. KV cache
+        entries written for rejected draft tokens lie past the accepted positions and
+        are overwritten by the next step.
 
-            if temperature > 0:
-                probs = torch.softmax(logits[:, -1] / temperature, dim=-1)
-                next_token = sample_top_p(probs, top_p)
-            else:
-                next_token = torch.argmax(logits[:, -1], dim=-1)
+        Args:
+            tokens (torch.Tensor): Token buffer of shape (1, total_len), filled up to
+                cur_pos.
+            lookup (Optional[PromptLookup]): Index of tokens[0, :cur_pos] that drafts
+                are looked up in when there is no draft model.
+            cur_pos (int): First position to generate.
+            total_len (int): Length of `tokens`.
 
-            next_token = next_token.reshape(-1)
-            # only replace token if prompt has already been generated
-            next_token = torch.where(
-                input_text_mask[:, cur_pos], tokens[:, cur_pos], next_token
-            )
-            tokens[:, cur_pos] = next_token
+        Returns:
+            Tuple[int, torch.Tensor]: The number n of tokens written to `tokens`, and the
+                logits of shape (n, V) they were chosen from.
+        """
+        # the verifying forward also predicts the position after the last draft token
+        k = min(self.speculative_tokens, total_len - cur_pos - 1)
+        if self.draft_model is not None:
+            draft = self._draft_tokens(tokens, cur_pos, k)
+        else:
+            draft = torch.tensor(lookup.propose(k), dtype=torch.long, device="cuda")
+        k = draft.shape[0]
+
+        inputs = torch.cat([tokens[0, cur_pos - 1 : cur_pos], draft])[None]
+        logits = self.model.forward(inputs, cur_pos - 1)[0]
+        target = logits.argmax(dim=-1)
+        accepted = int((draft == target[:k]).cumprod(dim=0).sum())
+        n = accepted + 1
+        tokens[0, cur_pos : cur_pos + n] = target[:n]
+
+        # the draft model's cache stays valid as far as its tokens were accepted
+        self._draft_pos = min(self._draft_pos, cur_pos + accepted)
+        return n, logits[:n]
+
+    def _draft_tokens(self, tokens: torch.Tensor, cur_pos: int, k: int) -> torch.Tensor:
+        """Propose k tokens for the positions from cur_pos on with the draft model."""
+        # catch up on the positions generated since the draft model last ran
+        inputs = tokens[:, self._draft_pos : cur_pos]
+        draft = []
+        for _ in range(k):
+            logits = self.draft_model.forward(inputs, self._draft_pos)
+            self._draft_pos += inputs.shape[1]
+            inputs = logits[:, -1].argmax(dim=-1, keepdim=True)
+            draft.append(inputs[0])
+        if not draft:
+            return tokens.new_empty(0)
+        return torch.cat(draft)
+
+    def _upload_prompt(self, dst: torch.Tensor, prompt_tokens: List[int]):
+        """
+        Copy `prompt_tokens` into the device tensor `dst` through pinned memory.
 
-            target = tokens[:, prev_pos + 1 : cur_pos + 1]
-            
-            if logprobs:
-                token_logprobs[:, prev_pos + 1 : cur_pos + 1] = -F.cross_entropy(
-                    input=logits.transpose(1, 2),
-                    target=target,
-                    reduction="none",
-                    ignore_index=pad_id,
-                )
-            eos_reached |= (~input_text_mask[:, cur_pos]) & (
-                torch.isin(next_token, stop_tokens)
+        The copy is issued asynchronously on a side stream, and the current stream
+        waits for it, so work queued after this call sees the prompt without the
+        host blocking on a pageable transfer.
+        """
+        if self._prompt_staging is None:
+            params = self.model.params
+            self._prompt_staging = torch.empty(
+                (params.max_batch_size, params.max_seq_len),
+                dtype=torch.long,
+                pin_memory=True,
             )
-            yield TokenResult(
-                token=next_token[0].item(),
-                text=self.tokenizer.decode(next_token.tolist()),
-                logprobs=(
-                    token_logprobs[:, prev_pos + 1 : cur_pos + 1][0].tolist()
-                    if logprobs
-                    else None
-                ),
+            self._copy_stream = torch.cuda.Stream()
+        if self._prompt_uploaded is not None:
+            # the previous upload may still be reading the staging buffer
+            self._prompt_uploaded.synchronize()
+        staging = self._prompt_staging[0, : len(prompt_tokens)]
+        staging.copy_(torch.as_tensor(prompt_tokens, dtype=torch.long))
+
+        # dst was just written on the current stream
+        self._copy_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(self._copy_stream):
+            dst.copy_(staging, non_blocking=True)
+        self._prompt_uploaded = self._copy_stream.record_event()
+        torch.cuda.current_stream().wait_stream(self._copy_stream)
+
+    def _decode_graph(self, bsz: int, greedy: bool, logprobs: bool) -> "DecodeGraph":
+        key = (bsz, greedy, logprobs)
+        if key not in self._decode_graphs:
+            self._decode_graphs[key] = DecodeGraph(
+                self.decode_step, bsz, greedy, logprobs
             )
-
-            prev_pos = cur_pos
-            if all(eos_reached):
-                break
+        return self._decode_graphs[key]
 
     def text_completion(
         self,
@@ -296,6 +603,10 @@ class Llama:
         token_logprobs = []
         decoded_tokens = []
 
+        # compared by id: the text of a stop token can carry pending bytes of the
+        # tokens before it
+        eot_id = self.tokenizer.special_tokens["<|eot_id|>"]
+        eom_id = self.tokenizer.special_tokens["<|eom_id|>"]
         stop_reason = None
         for result in self.generate(
             model_input=self.formatter.encode_dialog_prompt(
@@ -307,9 +618,9 @@ class Llama:
             logprobs=logprobs,
         ):
             tokens.append(result.token)
-            if result.text == "<|eot_id|>":
+            if result.token == eot_id:
                 stop_reason = StopReason.end_of_turn
-            elif result.text == "<|eom_id|>":
+            elif result.token == eom_id:
                 stop_reason = StopReason.end_of_message
 
             if logprobs:
@@ -331,6 +642,258 @@ class Llama:
         return ChatPrediction(generation=message)
 
 
+class DecodeGraph:
+    """
+    A single decode step (forward + sampling) captured as one CUDA graph.
+
+    Inputs and outputs live in static tensors: callers write `token` and `pos`
+    (and `temperature` / `top_p` when sampling), call `run`, and read the returned
+    tensors before the next `run` overwrites them. With `logprobs`, the graph also
+    computes the logprob of the sampled token, so no per-step kernels run outside
+    of it. The graph is captured on the first `run` using the inputs already
+    written, so the warm-up iterations rewrite the same KV cache entries the real
+    step would.
+    """
+
+    def __init__(self, decode_step: Callable, bsz: int, greedy: bool, logprobs: bool):
+        self.decode_step = decode_step
+        self.greedy = greedy
+        self.logprobs = logprobs
+        self.token = torch.zeros((bsz, 1), dtype=torch.long, device="cuda")
+        self.pos = torch.zeros(1, dtype=torch.long, device="cuda")
+        self.temperature = torch.ones((), dtype=torch.float, device="cuda")
+        self.top_p = torch.ones((), dtype=torch.float, device="cuda")
+        self.graph: Optional[torch.cuda.CUDAGraph] = None
+
+    def step(self) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        logits = self.decode_step(self.token, self.pos)[:, -1]
+        next_token = sample(logits, self.temperature, self.top_p, self.greedy)
+        if not self.logprobs:
+            return next_token, None
+        return next_token, token_logprob(logits, next_token)
+
+    def run(self) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        if self.graph is None:
+            # warm up on a side stream so lazy initialization (cuBLAS workspaces,
+            # torch.compile) happens outside of the capture
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                for _ in range(3):
+                    self.step()
+            torch.cuda.current_stream().wait_stream(stream)
+
+            self.graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(self.graph):
+                self.next_token, self.token_logprob = self.step()
+
+        self.graph.replay()
+        return self.next_token, self.token_logprob
+
+
+@contextmanager
+def default_dtype(dtype: torch.dtype):
+    """Temporarily set the default floating point dtype for newly created tensors."""
+    prev_dtype = torch.get_default_dtype()
+    torch.set_default_dtype(dtype)
+    try:
+        yield
+    finally:
+        torch.set_default_dtype(prev_dtype)
+
+
+def load_weights(model: nn.Module, ckpt_path: Path, device: str):
+    """
+    Load a checkpoint shard into the parameters of `model`.
+
+    A `.safetensors` shard is memory-mapped and each tensor is read directly onto
+    `device` and copied into its parameter. A `.pth` shard is memory-mapped by
+    `torch.load` and loaded with `load_state_dict`. Either way the shard is never
+    held in host memory as a whole.
+
+    Args:
+        model (nn.Module): Model whose parameters are overwritten.
+        ckpt_path (Path): Path to a `.safetensors` or `.pth` checkpoint shard.
+        device (str): Device the safetensors tensors are read onto.
+    """
+    if ckpt_path.suffix == ".safetensors":
+        state_dict = model.state_dict()
+        with safe_open(str(ckpt_path), framework="pt", device=device) as f:
+            for name in f.keys():
+                # like load_state_dict(strict=False), skip entries the model has
+                # no parameter for
+                if name in state_dict:
+                    state_dict[name].copy_(f.get_tensor(name))
+    else:
+        checkpoint = torch.load(
+            ckpt_path, map_location="cpu", weights_only=True, mmap=True
+        )
+        model.load_state_dict(checkpoint, strict=False)
+
+
+def quantize_weights(model: nn.Module, quantization: str):
+    """
+    Apply torchao weight-only quantization to the linear layers of a model in place.
+
+    Args:
+        model (nn.Module): Model whose linear layers should be quantized.
+        quantization (str): Either "int8" or "fp8".
+    """
+    from torchao.quantization import float8_weight_only, int8_weight_only, quantize_
+
+    configs = {
+        "int8": int8_weight_only,
+        "fp8": float8_weight_only,
+    }
+    assert (
+        quantization in configs
+    ), f"Unsupported quantization {quantization}, expected one of {list(configs)}"
+
+    # the model parallel layers are not nn.Linear subclasses but still go through
+    # F.linear, so the quantized weight tensors dispatch the same way
+    linear_types = (nn.Linear, ColumnParallelLinear, RowParallelLinear)
+    quantize_(
+        model,
+        configs[quantization](),
+        filter_fn=lambda module, _fqn: isinstance(module, linear_types),
+    )
+
+
+def prompt_logprobs(
+    model: Transformer, h: torch.Tensor, targets: torch.Tensor, pad_id: int
+) -> torch.Tensor:
+    """
+    Compute the log-probabilities of `targets` from the final hidden states.
+
+    When verl's fused linear cross-entropy kernel is available, the vocab projection
+    and the log-softmax are computed blockwise, so the (bsz, seqlen, vocab_size)
+    logits tensor is never materialized. The kernel needs the full, unquantized
+    output weight, so it is only used without model parallelism or quantization.
+
+    Args:
+        model (Transformer): Model providing the output projection.
+        h (torch.Tensor): Normalized hidden states of shape (bsz, seqlen, dim).
+        targets (torch.Tensor): Token ids predicted by `h`, of shape (bsz, seqlen).
+        pad_id (int): Padding token id; its positions get a logprob of 0.
+
+    Returns:
+        torch.Tensor: Log-probabilities of shape (bsz, seqlen).
+    """
+    weight = model.output.weight
+    if (
+        linear_cross_entropy is not None
+        and model_parallel_world_size() == 1
+        and type(weight) is nn.Parameter
+    ):
+        bsz, seqlen, dim = h.shape
+        # autograd.Function.apply only takes positional arguments
+        logprobs, _entropy = linear_cross_entropy(
+            h.reshape(-1, dim), weight, targets.reshape(-1), 1.0, "none"
+        )
+        return logprobs.view(bsz, seqlen).masked_fill(targets == pad_id, 0.0)
+
+    logprobs = token_logprob(model.output(h).float(), targets)
+    return logprobs.masked_fill(targets == pad_id, 0.0)
+
+
+class PromptLookup:
+    """
+    Propose draft tokens by looking the end of the context up in itself.
+
+    The latest earlier occurrence of the trailing n-gram of the context is looked up,
+    longest n first, and the tokens that followed it are proposed. Repeated spans
+    (code, quoted passages, retrieved documents) are common in chat prompts, which
+    makes this a cheap draft source that needs no second model. The latest position
+    of every n-gram is indexed as tokens are appended, so a lookup does not depend on
+    the length of the context.
+
+    Args:
+        max_ngram (int, optional): Longest n-gram to match. Defaults to
+            PROMPT_LOOKUP_MAX_NGRAM.
+    """
+
+    def __init__(self, max_ngram: int = PROMPT_LOOKUP_MAX_NGRAM):
+        self.max_ngram = max_ngram
+        self.history: List[int] = []
+        # n-gram -> position right after its latest occurrence that has a successor
+        self._next_pos: Dict[Tuple[int, ...], int] = {}
+
+    def extend(self, tokens: List[int]):
+        """Append tokens to the context."""
+        for token in tokens:
+            # the n-grams ending at the current last token are now followed by one
+            end = len(self.history)
+            for n in range(1, min(self.max_ngram, end) + 1):
+                self._next_pos[tuple(self.history[end - n : end])] = end
+            self.history.append(token)
+
+    def propose(self, k: int) -> List[int]:
+        """
+        Propose up to k tokens to follow the context.
+
+        Args:
+            k (int): Maximum number of tokens to propose.
+
+        Returns:
+            List[int]: The proposed tokens; empty when nothing matches.
+        """
+        if k <= 0:
+            return []
+        end = len(self.history)
+        for n in range(min(self.max_ngram, end - 1), 0, -1):
+            start = self._next_pos.get(tuple(self.history[end - n :]))
+            if start is not None:
+                return self.history[start : start + k]
+        return []
+
+
+def token_logprob(logits: torch.Tensor, next_token: torch.Tensor) -> torch.Tensor:
+    """
+    Log-probability of `next_token` of shape (...) under `logits` of shape (..., V).
+
+    Only the normalizer is reduced over the vocabulary; unlike `log_softmax` followed
+    by a gather, no (..., V) tensor of log-probabilities is materialized.
+    """
+    picked = logits.gather(-1, next_token[..., None]).squeeze(-1)
+    return picked - logits.logsumexp(dim=-1)
+
+
+def sample(logits, temperature, top_p, greedy: bool):
+    """
+    Pick the next token from last-position logits of shape (bsz, vocab_size).
+
+    `temperature` and `top_p` may be floats or 0-dim tensors; the latter keeps the
+    sampling path free of host values so it can be captured in a CUDA graph.
+    """
+    if greedy:
+        return torch.argmax(logits, dim=-1)
+    return sample_top_p_from_logits(logits, temperature, top_p).reshape(-1)
+
+
+def sample_top_p_from_logits(logits, temperature, p):
+    """
+    Sample from temperature-scaled logits with top-p (nucleus) filtering.
+
+    Uses flashinfer's fused top-k/top-p sampling kernel when it is installed and
+    falls back to `sample_top_p` otherwise. Both restrict sampling to the
+    `TOP_K_PREFILTER` most likely tokens before applying the top-p cutoff.
+
+    Args:
+        logits (torch.Tensor): Logits of shape (bsz, vocab_size).
+        temperature (float | torch.Tensor): Sampling temperature, must be positive.
+        p (float | torch.Tensor): Probability threshold for top-p sampling.
+
+    Returns:
+        torch.Tensor: Sampled token indices.
+    """
+    if top_k_top_p_sampling_from_logits is not None:
+        return top_k_top_p_sampling_from_logits(
+            logits / temperature, TOP_K_PREFILTER, p
+        ).long()
+    probs = torch.softmax(logits / temperature, dim=-1)
+    return sample_top_p(probs, p)
+
+
 def sample_top_p(probs, p):
     """
     Perform top-p (nucleus) sampling on a probability distribution.
@@ -344,13 +907,22 @@ def sample_top_p(probs, p):
 
     Note:
         Top-p sampling selects the smallest set of tokens whose cumulative probability mass
-        exceeds the threshold p. The distribution is renormalized based on the selected tokens.
+        exceeds the threshold p. The token is drawn from the selected tokens in proportion
+        to their probabilities.
+        Only the `TOP_K_PREFILTER` most likely tokens are considered, which avoids sorting
+        the full vocabulary.
     """
-    probs_sort, probs_idx = torch.sort(probs, dim=-1, descending=True)
+    k = min(TOP_K_PREFILTER, probs.shape[-1])
+    probs_sort, probs_idx = torch.topk(probs, k, dim=-1)
     probs_sum = torch.cumsum(probs_sort, dim=-1)
     mask = probs_sum - probs_sort > p
-    probs_sort[mask] = 0.0
-    probs_sort.div_(probs_sort.sum(dim=-1, keepdim=True))
-    next_token = torch.multinomial(probs_sort, num_samples=1)
+    probs_sort.masked_fill_(mask, 0.0)
+    # Draw with the exponential race, argmax(probs / Exp(1)), which samples in
+    # proportion to probs without renormalizing. Unlike torch.multinomial it does
+    # not check its input on the host, so it can be captured in a CUDA graph. The
+    # noise is clamped away from 0 so filtered tokens never become 0 / 0.
+    noise = torch.empty_like(probs_sort).exponential_(1)
+    noise.clamp_min_(torch.finfo(noise.dtype).tiny)
+    next_token = probs_sort.div_(noise).argmax(dim=-1, keepdim=True)
     next_token = torch.gather(probs_idx, -1, next_token)
     return next_token
@@ -9,7 +9,7 @@
 # This software may be used and distributed in accordance with the terms of the Llama 3 Community License Agreement.
 
 import math
-from typing import Optional, Tuple
+from typing import Optional, Tuple, Union
 
 import fairscale.nn.model_parallel.initialize as fs_init
 import torch
@@ -20,6 +20,7 @@ from fairscale.nn.model_parallel.layers import (
     VocabParallelEmbedding,
 )
 from torch import nn
+from torch.nn.utils import skip_init
 
 from ..api import ModelArgs
 
@@ -27,6 +28,140 @@ from ..api import ModelArgs
 # dependencies. These dependencies are not part of the default dependencies
 # (requirements.txt) of the `llama-models` package.
 
+# Number of token positions held by one block of the paged KV cache.
+KV_BLOCK_SIZE = 16
+
+
+def model_parallel_world_size() -> int:
+    """Model parallel world size, or 1 if model parallelism was never initialized."""
+    if not fs_init.model_parallel_is_initialized():
+        return 1
+    return fs_init.get_model_parallel_world_size()
+
+
+# Without model parallelism the fairscale layers only add no-op collectives (and
+# autograd functions torch.compile cannot trace), so plain torch layers are used
+# instead. Parameter names match, so checkpoints load either way. Like the
+# fairscale layers (`init_method=lambda x: x`), weights are left uninitialized.
+
+
+def column_parallel_linear(
+    in_features: int, out_features: int, gather_output: bool = True
+) -> nn.Module:
+    if model_parallel_world_size() == 1:
+        return skip_init(
+            nn.Linear,
+            in_features,
+            out_features,
+            bias=False,
+            device=torch.get_default_device(),
+        )
+    return ColumnParallelLinear(
+        in_features,
+        out_features,
+        bias=False,
+        gather_output=gather_output,
+        init_method=lambda x: x,
+    )
+
+
+def row_parallel_linear(in_features: int, out_features: int) -> nn.Module:
+    if model_parallel_world_size() == 1:
+        return skip_init(
+            nn.Linear,
+            in_features,
+            out_features,
+            bias=False,
+            device=torch.get_default_device(),
+        )
+    return RowParallelLinear(
+        in_features,
+        out_features,
+        bias=False,
+        input_is_parallel=True,
+        init_method=lambda x: x,
+    )
+
+
+def vocab_parallel_embedding(num_embeddings: int, embedding_dim: int) -> nn.Module:
+    if model_parallel_world_size() == 1:
+        return skip_init(
+            nn.Embedding,
+            num_embeddings,
+            embedding_dim,
+            device=torch.get_default_device(),
+        )
+    return VocabParallelEmbedding(
+        num_embeddings, embedding_dim, init_method=lambda x: x
+    )
+
+
+class KVBlockAllocator:
+    """
+    Hands out fixed-size KV cache blocks to sequences from a pool shared by all of them.
+
+    Each sequence slot owns a row of `block_table` mapping its logical blocks to
+    physical blocks of the pool, so memory is only committed as a sequence grows.
+    Block 0 is never handed out: unused table entries point at it, which lets the
+    static-shape decode path gather a full row; the positions it covers are masked.
+
+    A pool with a block for every position of every slot is `contiguous`: each slot
+    owns a fixed run of blocks, in order, so attention can read the cache as a dense
+    view instead of gathering blocks.
+    """
+
+    def __init__(
+        self,
+        num_blocks: int,
+        max_batch_size: int,
+        max_blocks_per_seq: int,
+        device: torch.device,
+    ):
+        assert num_blocks > 1, "the KV cache needs at least one usable block"
+        self.contiguous = num_blocks > max_batch_size * max_blocks_per_seq
+        # a sequence can never hold more blocks than the pool has
+        self.blocks_per_seq = min(max_blocks_per_seq, num_blocks - 1)
+        self.free_blocks = list(range(num_blocks - 1, 0, -1))
+        self.seq_blocks = [[] for _ in range(max_batch_size)]
+        self.block_table = torch.zeros(
+            (max_batch_size, self.blocks_per_seq), dtype=torch.long, device=device
+        )
+        if self.contiguous:
+            self.free_blocks = []
+            self.block_table.copy_(
+                torch.arange(1, max_batch_size * max_blocks_per_seq + 1).view(
+                    max_batch_size, max_blocks_per_seq
+                )
+            )
+
+    def reserve(self, seq_id: int, num_tokens: int):
+        """Make sure sequence `seq_id` has blocks for its first `num_tokens` positions."""
+        if self.contiguous:
+            # every slot already owns blocks for all of its positions
+            return
+        blocks = self.seq_blocks[seq_id]
+        needed = (num_tokens + KV_BLOCK_SIZE - 1) // KV_BLOCK_SIZE - len(blocks)
+        if needed <= 0:
+            return
+        if needed > len(self.free_blocks):
+            raise RuntimeError(
+                f"Out of KV cache blocks: need {needed}, {len(self.free_blocks)} free"
+            )
+        new_blocks = [self.free_blocks.pop() for _ in range(needed)]
+        self.block_table[seq_id, len(blocks) : len(blocks) + needed] = torch.tensor(
+            new_blocks, dtype=torch.long
+        )
+        blocks.extend(new_blocks)
+
+    def free(self, seq_id: int):
+        """Return all blocks of sequence `seq_id` to the pool."""
+        if self.contiguous:
+            return
+        blocks = self.seq_blocks[seq_id]
+        self.free_blocks.extend(reversed(blocks))
+        blocks.clear()
+        self.block_table[seq_id].zero_()
+
 
 class RMSNorm(torch.nn.Module):
     def __init__(self, dim: int, eps: float = 1e-6):
@@ -116,64 +251,97 @@ class Attention(nn.Module):
     def __init__(self, args: ModelArgs):
         super().__init__()
         self.n_kv_heads = args.n_heads if args.n_kv_heads is None else args.n_kv_heads
-        model_parallel_size = fs_init.get_model_parallel_world_size()
+        model_parallel_size = model_parallel_world_size()
         self.n_local_heads = args.n_heads // model_parallel_size
         self.n_local_kv_heads = self.n_kv_heads // model_parallel_size
         self.n_rep = self.n_local_heads // self.n_local_kv_heads
         self.head_dim = args.dim // args.n_heads
+        self.max_batch_size = args.max_batch_size
 
-        self.wq = ColumnParallelLinear(
-            args.dim,
-            args.n_heads * self.head_dim,
-            bias=False,
-            gather_output=False,
-            init_method=lambda x: x,
-        )
-        self.wk = ColumnParallelLinear(
-            args.dim,
-            self.n_kv_heads * self.head_dim,
-            bias=False,
-            gather_output=False,
-            init_method=lambda x: x,
+        self.wq = column_parallel_linear(
+            args.dim, args.n_heads * self.head_dim, gather_output=False
         )
-        self.wv = ColumnParallelLinear(
-            args.dim,
-            self.n_kv_heads * self.head_dim,
-            bias=False,
-            gather_output=False,
-            init_method=lambda x: x,
+        self.wk = column_parallel_linear(
+            args.dim, self.n_kv_heads * self.head_dim, gather_output=False
         )
-        self.wo = RowParallelLinear(
-            args.n_heads * self.head_dim,
-            args.dim,
-            bias=False,
-            input_is_parallel=True,
-            init_method=lambda x: x,
+        self.wv = column_parallel_linear(
+            args.dim, self.n_kv_heads * self.head_dim, gather_output=False
         )
+        self.wo = row_parallel_linear(args.n_heads * self.head_dim, args.dim)
+
+        # Paged KV cache of shape (num_blocks, KV_BLOCK_SIZE, n_local_kv_heads,
+        # head_dim), allocated by `setup_cache`. Registered as buffers so torch.compile
+        # / CUDA graphs treat them as static, in-place mutated state.
+        self.register_buffer("cache_k", None, persistent=False)
+        self.register_buffer("cache_v", None, persistent=False)
+
+    def setup_cache(self, num_blocks: int, dtype: torch.dtype, device: torch.device):
+        shape = (num_blocks, KV_BLOCK_SIZE, self.n_local_kv_heads, self.head_dim)
+        self.cache_k = torch.zeros(shape, dtype=dtype, device=device)
+        self.cache_v = torch.zeros(shape, dtype=dtype, device=device)
+
+    def _update_dense_cache(
+        self, start_pos: Union[int, torch.Tensor], xk: torch.Tensor, xv: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        # a contiguous pool: slot s owns the blocks after the null block in order,
+        # so the cache reads as a (max_batch_size, max_len, ...) view
+        bsz, seqlen = xk.shape[:2]
+        shape = (self.max_batch_size, -1, self.n_local_kv_heads, self.head_dim)
+        cache_k = self.cache_k[1:].view(shape)
+        cache_v = self.cache_v[1:].view(shape)
+        if isinstance(start_pos, torch.Tensor):
+            # static-shape decode: write in place at the positions held in start_pos
+            # and attend over the whole cache, leaving it to `mask` to hide the
+            # entries that have not been written yet
+            cache_k[:bsz].index_copy_(1, start_pos, xk)
+            cache_v[:bsz].index_copy_(1, start_pos, xv)
+            return cache_k[:bsz], cache_v[:bsz]
+
+        cache_k[:bsz, start_pos : start_pos + seqlen] = xk
+        cache_v[:bsz, start_pos : start_pos + seqlen] = xv
+        return cache_k[:bsz, : start_pos + seqlen], cache_v[:bsz, : start_pos + seqlen]
+
+    def _update_paged_cache(
+        self,
+        start_pos: Union[int, torch.Tensor],
+        xk: torch.Tensor,
+        xv: torch.Tensor,
+        block_table: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        bsz, seqlen = xk.shape[:2]
+        if isinstance(start_pos, torch.Tensor):
+            # static-shape decode: attend over every block in the table, leaving it
+            # to `mask` to hide the entries that have not been written yet
+            positions = start_pos
+            num_blocks = block_table.shape[1]
+        else:
+            positions = torch.arange(start_pos, start_pos + seqlen, device=xk.device)
+            num_blocks = (start_pos + seqlen + KV_BLOCK_SIZE - 1) // KV_BLOCK_SIZE
 
-        self.cache_k = torch.zeros(
-            (
-                args.max_batch_size,
-                args.max_seq_len,
-                self.n_local_kv_heads,
-                self.head_dim,
-            )
-        ).cuda()
-        self.cache_v = torch.zeros(
-            (
-                args.max_batch_size,
-                args.max_seq_len,
-                self.n_local_kv_heads,
-                self.head_dim,
-            )
-        ).cuda()
+        # scatter the new keys/values into their slots in the flattened pool
+        slots = (
+            block_table[:bsz, positions // KV_BLOCK_SIZE] * KV_BLOCK_SIZE
+            + positions % KV_BLOCK_SIZE
+        )
+        self.cache_k.view(-1, self.n_local_kv_heads, self.head_dim)[slots] = xk
+        self.cache_v.view(-1, self.n_local_kv_heads, self.head_dim)[slots] = xv
+
+        # gather this sequence's blocks back into a contiguous (bsz, len, ...) tensor
+        blocks = block_table[:bsz, :num_blocks]
+        keys = self.cache_k[blocks].flatten(1, 2)
+        values = self.cache_v[blocks].flatten(1, 2)
+        if not isinstance(start_pos, torch.Tensor):
+            keys = keys[:, : start_pos + seqlen]
+            values = values[:, : start_pos + seqlen]
+        return keys, values
 
     def forward(
         self,
         x: torch.Tensor,
-        start_pos: int,
+        start_pos: Union[int, torch.Tensor],
         freqs_cis: torch.Tensor,
         mask: Optional[torch.Tensor],
+        block_table: Optional[torch.Tensor],
     ):
         bsz, seqlen, _ = x.shape
         xq, xk, xv = self.wq(x), self.wk(x), self.wv(x)
@@ -184,14 +352,10 @@ class Attention(nn.Module):
 
         xq, xk = apply_rotary_emb(xq, xk, freqs_cis=freqs_cis)
 
-        self.cache_k = self.cache_k.to(xq)
-        self.cache_v = self.cache_v.to(xq)
-
-        self.cache_k[:bsz, start_pos : start_pos + seqlen] = xk
-        self.cache_v[:bsz, start_pos : start_pos + seqlen] = xv
-
-        keys = self.cache_k[:bsz, : start_pos + seqlen]
-        values = self.cache_v[:bsz, : start_pos + seqlen]
+        if block_table is None:
+            keys, values = self._update_dense_cache(start_pos, xk, xv)
+        else:
+            keys, values = self._update_paged_cache(start_pos, xk, xv, block_table)
 
         # repeat k/v heads if n_kv_heads < n_heads
         keys = repeat_kv(
@@ -230,15 +394,9 @@ class FeedForward(nn.Module):
             hidden_dim = int(ffn_dim_multiplier * hidden_dim)
         hidden_dim = multiple_of * ((hidden_dim + multiple_of - 1) // multiple_of)
 
-        self.w1 = ColumnParallelLinear(
-            dim, hidden_dim, bias=False, gather_output=False, init_method=lambda x: x
-        )
-        self.w2 = RowParallelLinear(
-            hidden_dim, dim, bias=False, input_is_parallel=True, init_method=lambda x: x
-        )
-        self.w3 = ColumnParallelLinear(
-            dim, hidden_dim, bias=False, gather_output=False, init_method=lambda x: x
-        )
+        self.w1 = column_parallel_linear(dim, hidden_dim, gather_output=False)
+        self.w2 = row_parallel_linear(hidden_dim, dim)
+        self.w3 = column_parallel_linear(dim, hidden_dim, gather_output=False)
 
     def forward(self, x):
         return self.w2(F.silu(self.w1(x)) * self.w3(x))
@@ -264,11 +422,14 @@ class TransformerBlock(nn.Module):
     def forward(
         self,
         x: torch.Tensor,
-        start_pos: int,
+        start_pos: Union[int, torch.Tensor],
         freqs_cis: torch.Tensor,
         mask: Optional[torch.Tensor],
+        block_table: Optional[torch.Tensor],
     ):
-        h = x + self.attention(self.attention_norm(x), start_pos, freqs_cis, mask)
+        h = x + self.attention(
+            self.attention_norm(x), start_pos, freqs_cis, mask, block_table
+        )
         out = h + self.feed_forward(self.ffn_norm(h))
         return out
 
@@ -280,29 +441,83 @@ class Transformer(nn.Module):
         self.vocab_size = params.vocab_size
         self.n_layers = params.n_layers
 
-        self.tok_embeddings = VocabParallelEmbedding(
-            params.vocab_size, params.dim, init_method=lambda x: x
-        )
+        self.tok_embeddings = vocab_parallel_embedding(params.vocab_size, params.dim)
 
         self.layers = torch.nn.ModuleList()
         for layer_id in range(params.n_layers):
             self.layers.append(TransformerBlock(layer_id, params))
 
         self.norm = RMSNorm(params.dim, eps=params.norm_eps)
-        self.output = ColumnParallelLinear(
-            params.dim, params.vocab_size, bias=False, init_method=lambda x: x
+        self.output = column_parallel_linear(params.dim, params.vocab_size)
+
+        self.max_blocks_per_seq = (
+            params.max_seq_len + KV_BLOCK_SIZE - 1
+        ) // KV_BLOCK_SIZE
+        self.kv_allocator: Optional[KVBlockAllocator] = None
+
+        self.register_buffer(
+            "freqs_cis",
+            precompute_freqs_cis(
+                params.dim // params.n_heads,
+                params.max_seq_len * 2,
+                params.rope_theta,
+                params.use_scaled_rope,
+            ),
+            persistent=False,
         )
 
-        self.freqs_cis = precompute_freqs_cis(
-            params.dim // params.n_heads,
-            params.max_seq_len * 2,
-            params.rope_theta,
-            params.use_scaled_rope,
+    def kv_cache_block_bytes(self) -> int:
+        """Memory taken by one KV cache block across all layers."""
+        attention = self.layers[0].attention
+        elem_size = self.tok_embeddings.weight.element_size()
+        return (
+            2
+            * self.n_layers
+            * KV_BLOCK_SIZE
+            * attention.n_local_kv_heads
+            * attention.head_dim
+            * elem_size
         )
 
+    def setup_kv_cache(self, num_blocks: Optional[int] = None):
+        """
+        Allocate the paged KV cache pool shared by all sequences.
+
+        Args:
+            num_blocks (Optional[int]): Number of KV_BLOCK_SIZE-token blocks in the
+                pool, including the reserved null block. Defaults to, and is capped at,
+                enough blocks for max_batch_size sequences of max_seq_len tokens; a
+                pool of that size is laid out contiguously and read without paging.
+        """
+        dense_blocks = self.params.max_batch_size * self.max_blocks_per_seq + 1
+        if num_blocks is None or num_blocks > dense_blocks:
+            num_blocks = dense_blocks
+        weight = self.tok_embeddings.weight
+        for layer in self.layers:
+            layer.attention.setup_cache(num_blocks, weight.dtype, weight.device)
+        self.kv_allocator = KVBlockAllocator(
+            num_blocks,
+            self.params.max_batch_size,
+            self.max_blocks_per_seq,
+            weight.device,
+        )
+
+    def _block_table(self) -> Optional[torch.Tensor]:
+        # None makes attention read a contiguous pool as a dense view
+        if self.kv_allocator.contiguous:
+            return None
+        return self.kv_allocator.block_table
+
     @torch.inference_mode()
-    def forward(self, tokens: torch.Tensor, start_pos: int):
-        _bsz, seqlen = tokens.shape
+    def forward(
+        self, tokens: torch.Tensor, start_pos: int, return_hidden: bool = False
+    ):
+        bsz, seqlen = tokens.shape
+        if self.kv_allocator is None:
+            self.setup_kv_cache()
+        for seq_id in range(bsz):
+            self.kv_allocator.reserve(seq_id, start_pos + seqlen)
+
         h = self.tok_embeddings(tokens)
         self.freqs_cis = self.freqs_cis.to(h.device)
         freqs_cis = self.freqs_cis[start_pos : start_pos + seqlen]
@@ -322,7 +537,43 @@ class Transformer(nn.Module):
             ).type_as(h)
 
         for layer in self.layers:
-            h = layer(h, start_pos, freqs_cis, mask)
+            h = layer(h, start_pos, freqs_cis, mask, self._block_table())
+        h = self.norm(h)
+        if return_hidden:
+            # let the caller decide which positions need the vocab projection
+            return h
+        output = self.output(h).float()
+        return output
+
+    def forward_decode(self, tokens: torch.Tensor, input_pos: torch.Tensor):
+        """
+        Run a single decode step with shapes that do not depend on the position.
+
+        Unlike `forward`, the position is passed as a 1-element tensor and attention
+        always spans every block of the sequence's block table, so the step can be
+        captured once by torch.compile / CUDA graphs and replayed for every token.
+        Callers are expected to already be in inference mode and, since the step
+        cannot allocate, to have reserved KV cache blocks up to `input_pos`.
+
+        Args:
+            tokens (torch.Tensor): Token ids of shape (bsz, 1).
+            input_pos (torch.Tensor): Position of `tokens` in the sequence, shape (1,).
+
+        Returns:
+            torch.Tensor: Logits of shape (bsz, 1, vocab_size).
+        """
+        h = self.tok_embeddings(tokens)
+        freqs_cis = self.freqs_cis[input_pos]
+
+        positions = torch.arange(
+            self.kv_allocator.blocks_per_seq * KV_BLOCK_SIZE, device=tokens.device
+        )
+        # (1, cache_len), 2-D like the prefill mask: torch.compile may lower the
+        # attention to SDPA, which rejects a 1-D mask
+        mask = torch.where(positions <= input_pos, 0.0, float("-inf")).type_as(h)[None]
+
+        for layer in self.layers:
+            h = layer(h, input_pos, freqs_cis, mask, self._block_table())
         h = self.norm(h)
         output = self.output(h).float()
         return output
@@ -0,0 +1,66 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the terms described in the LICENSE file in
+# top-level folder for each specific model found within the models/ directory at
+# the top-level of this source tree.
+
+import unittest
+
+import torch
+
+from llama_models.llama3.reference_impl.model import KV_BLOCK_SIZE, KVBlockAllocator
+
+
+class KVBlockAllocatorTests(unittest.TestCase):
+    def allocator(self, num_blocks: int) -> KVBlockAllocator:
+        return KVBlockAllocator(
+            num_blocks, max_batch_size=2, max_blocks_per_seq=4, device="cpu"
+        )
+
+    def test_reserve_rounds_up_to_blocks(self):
+        allocator = self.allocator(6)
+        allocator.reserve(0, KV_BLOCK_SIZE + 1)
+        self.assertEqual(len(allocator.seq_blocks[0]), 2)
+        allocator.reserve(0, 2 * KV_BLOCK_SIZE)
+        self.assertEqual(len(allocator.seq_blocks[0]), 2)
+        self.assertEqual(allocator.block_table[0, :2].tolist(), allocator.seq_blocks[0])
+
+    def test_null_block_is_never_handed_out(self):
+        allocator = self.allocator(6)
+        allocator.reserve(0, 3 * KV_BLOCK_SIZE)
+        allocator.reserve(1, 2 * KV_BLOCK_SIZE)
+        used = allocator.seq_blocks[0] + allocator.seq_blocks[1]
+        self.assertEqual(sorted(used), [1, 2, 3, 4, 5])
+
+    def test_exhaustion(self):
+        allocator = self.allocator(4)
+        allocator.reserve(0, 2 * KV_BLOCK_SIZE)
+        with self.assertRaises(RuntimeError):
+            allocator.reserve(1, 2 * KV_BLOCK_SIZE)
+        # a failed reservation takes nothing from the pool
+        self.assertEqual(allocator.seq_blocks[1], [])
+        self.assertEqual(len(allocator.free_blocks), 1)
+
+    def test_free_and_reuse(self):
+        allocator = self.allocator(4)
+        allocator.reserve(0, 3 * KV_BLOCK_SIZE)
+        blocks = list(allocator.seq_blocks[0])
+        allocator.free(0)
+        self.assertEqual(allocator.seq_blocks[0], [])
+        self.assertTrue(torch.all(allocator.block_table[0] == 0))
+        allocator.reserve(1, 3 * KV_BLOCK_SIZE)
+        self.assertEqual(sorted(allocator.seq_blocks[1]), sorted(blocks))
+
+    def test_table_capped_at_pool_size(self):
+        allocator = self.allocator(3)
+        self.assertFalse(allocator.contiguous)
+        self.assertEqual(allocator.block_table.shape, (2, 2))
+
+    def test_contiguous_pool(self):
+        allocator = self.allocator(9)
+        self.assertTrue(allocator.contiguous)
+        self.assertEqual(allocator.block_table.tolist(), [[1, 2, 3, 4], [5, 6, 7, 8]])
+        allocator.reserve(0, 4 * KV_BLOCK_SIZE)
+        allocator.free(0)
+        self.assertEqual(allocator.block_table[0].tolist(), [1, 2, 3, 4])
@@ -0,0 +1,75 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the terms described in the LICENSE file in
+# top-level folder for each specific model found within the models/ directory at
+# the top-level of this source tree.
+
+import unittest
+
+import torch
+
+from llama_models.llama3.api.args import ModelArgs
+from llama_models.llama3.reference_impl.model import Transformer
+
+
+def tiny_model() -> Transformer:
+    torch.manual_seed(0)
+    args = ModelArgs(
+        dim=64,
+        n_layers=2,
+        n_heads=4,
+        n_kv_heads=2,
+        vocab_size=256,
+        multiple_of=32,
+        max_seq_len=64,
+        max_batch_size=2,
+    )
+    model = Transformer(args)
+    for param in model.parameters():
+        torch.nn.init.normal_(param, std=0.1)
+    return model
+
+
+class DecodeStepTests(unittest.TestCase):
+    def test_compiled_decode_matches_forward(self):
+        model = tiny_model()
+        tokens = torch.randint(0, model.vocab_size, (1, 12))
+        expected = model.forward(tokens, 0)[:, -1]
+
+        model.forward(tokens[:, :-1], 0)
+        decode_step = torch.compile(model.forward_decode, fullgraph=True, dynamic=False)
+        with torch.inference_mode():
+            logits = decode_step(tokens[:, -1:], torch.tensor([11]))
+        torch.testing.assert_close(logits[:, -1], expected, atol=1e-4, rtol=1e-4)
+
+
+class PagedKVCacheTests(unittest.TestCase):
+    def run_model(self, model: Transformer, tokens: torch.Tensor):
+        prompt_len = tokens.shape[1] - 4
+        prefill = model.forward(tokens[:, :prompt_len], 0)
+        steps = []
+        with torch.inference_mode():
+            for pos in range(prompt_len, tokens.shape[1]):
+                model.kv_allocator.reserve(0, pos + 1)
+                steps.append(
+                    model.forward_decode(tokens[:, pos : pos + 1], torch.tensor([pos]))
+                )
+        return prefill, torch.cat(steps, dim=1)
+
+    def test_paged_matches_dense(self):
+        model = tiny_model()
+        tokens = torch.randint(0, model.vocab_size, (1, 40))
+
+        model.setup_kv_cache()
+        self.assertTrue(model.kv_allocator.contiguous)
+        dense_prefill, dense_steps = self.run_model(model, tokens)
+
+        model.setup_kv_cache(5)
+        self.assertFalse(model.kv_allocator.contiguous)
+        # take the first block so the sequence is not laid out in order
+        model.kv_allocator.reserve(1, 1)
+        paged_prefill, paged_steps = self.run_model(model, tokens)
+
+        torch.testing.assert_close(paged_prefill, dense_prefill)
+        torch.testing.assert_close(paged_steps, dense_steps)
@@ -0,0 +1,60 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the terms described in the LICENSE file in
+# top-level folder for each specific model found within the models/ directory at
+# the top-level of this source tree.
+
+import random
+import unittest
+from typing import List
+
+from llama_models.llama3.reference_impl.generation import PromptLookup
+
+
+def propose(history: List[int], k: int, max_ngram: int = 3) -> List[int]:
+    lookup = PromptLookup(max_ngram)
+    lookup.extend(history)
+    return lookup.propose(k)
+
+
+class PromptLookupTests(unittest.TestCase):
+    def test_no_match(self):
+        self.assertEqual(propose([1, 2, 3, 4], 3), [])
+
+    def test_no_tokens_requested(self):
+        self.assertEqual(propose([1, 2, 3, 1, 2], 0), [])
+
+    def test_continues_earlier_occurrence(self):
+        self.assertEqual(propose([5, 6, 7, 8, 5, 6], 2), [7, 8])
+
+    def test_truncated_at_end_of_history(self):
+        self.assertEqual(propose([5, 6, 7, 5, 6], 4), [7, 5, 6])
+
+    def test_prefers_longest_ngram(self):
+        # the unigram 3 last occurred before 9, but the bigram 2 3 before 4
+        history = [2, 3, 4, 3, 9, 2, 3]
+        self.assertEqual(propose(history, 1), [4])
+
+    def test_prefers_most_recent_match(self):
+        history = [1, 7, 1, 8, 1]
+        self.assertEqual(propose(history, 1, max_ngram=1), [8])
+
+    def test_incremental_matches_full_scan(self):
+        rng = random.Random(0)
+        history = [rng.randrange(4) for _ in range(200)]
+        lookup = PromptLookup(3)
+        for end in range(0, len(history), 7):
+            lookup.extend(history[end : end + 7])
+            context = history[: end + 7]
+            expected = []
+            for n in range(min(3, len(context) - 1), 0, -1):
+                starts = [
+                    start
+                    for start in range(len(context) - n)
+                    if context[start : start + n] == context[-n:]
+                ]
+                if starts:
+                    expected = context[starts[-1] + n : starts[-1] + n + 5]
+                    break
+            self.assertEqual(lookup.propose(5), expected)
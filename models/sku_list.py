@@ -7,12 +7,13 @@
 
 from dataclasses import dataclass
 from functools import lru_cache
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 
 from .datatypes import (
     CheckpointQuantizationFormat,
     CoreModelId,
     Model,
+    ModelFamily,
     SamplingParams,
     SamplingStrategy,
 )
@@ -21,22 +22,115 @@ LLAMA2_VOCAB_SIZE = 32000
 LLAMA3_VOCAB_SIZE = 128256
 
 
+# model_args shared by the registered models. Base and chat/instruct variants, and
+# the Llama Guard models built on a base model, use the same architecture.
+_LLAMA2_7B_ARGS = {
+    "dim": 4096,
+    "n_layers": 32,
+    "n_heads": 32,
+    "n_kv_heads": 8,
+    "vocab_size": LLAMA2_VOCAB_SIZE,
+    "ffn_dim_multiplier": 1.3,
+    "multiple_of": 256,
+    "norm_eps": 1e-05,
+    "rope_theta": 500000.0,
+    "use_scaled_rope": False,
+}
+_LLAMA2_13B_ARGS = {
+    "dim": 5120,
+    "n_layers": 40,
+    "n_heads": 40,
+    "n_kv_heads": 8,
+    "vocab_size": LLAMA2_VOCAB_SIZE,
+    "ffn_dim_multiplier": 1.3,
+    "multiple_of": 256,
+    "norm_eps": 1e-05,
+    "rope_theta": 500000.0,
+    "use_scaled_rope": False,
+}
+_LLAMA2_70B_ARGS = {
+    "dim": 8192,
+    "n_layers": 80,
+    "n_heads": 64,
+    "n_kv_heads": 8,
+    "vocab_size": LLAMA2_VOCAB_SIZE,
+    "ffn_dim_multiplier": 1.3,
+    "multiple_of": 4096,
+    "norm_eps": 1e-05,
+    "rope_theta": 500000.0,
+    "use_scaled_rope": False,
+}
+_LLAMA2_70B_CHAT_ARGS = {**_LLAMA2_70B_ARGS, "multiple_of": 256}
+_LLAMA3_8B_ARGS = {
+    "dim": 4096,
+    "n_layers": 32,
+    "n_heads": 32,
+    "n_kv_heads": 8,
+    "vocab_size": LLAMA3_VOCAB_SIZE,
+    "ffn_dim_multiplier": 1.3,
+    "multiple_of": 1024,
+    "norm_eps": 1e-05,
+    "rope_theta": 500000.0,
+    "use_scaled_rope": False,
+}
+_LLAMA3_70B_ARGS = {
+    "dim": 8192,
+    "n_layers": 80,
+    "n_heads": 64,
+    "n_kv_heads": 8,
+    "vocab_size": LLAMA3_VOCAB_SIZE,
+    "ffn_dim_multiplier": 1.3,
+    "multiple_of": 4096,
+    "norm_eps": 1e-05,
+    "rope_theta": 500000.0,
+    "use_scaled_rope": False,
+}
+_LLAMA3_1_8B_ARGS = {**_LLAMA3_8B_ARGS, "use_scaled_rope": True}
+_LLAMA3_1_70B_ARGS = {**_LLAMA3_70B_ARGS, "use_scaled_rope": True}
+_LLAMA3_1_405B_ARGS = {
+    "dim": 16384,
+    "n_layers": 126,
+    "n_heads": 128,
+    "n_kv_heads": 8,
+    "vocab_size": LLAMA3_VOCAB_SIZE,
+    "ffn_dim_multiplier": 1.2,
+    "multiple_of": 4096,
+    "norm_eps": 1e-05,
+    "rope_theta": 500000.0,
+    "use_scaled_rope": True,
+}
+_LLAMA3_1_405B_MP16_ARGS = {**_LLAMA3_1_405B_ARGS, "n_kv_heads": 16}
+
+
 def resolve_model(descriptor: str) -> Optional[Model]:
+    return _descriptor_index().get(descriptor)
+
+
+@lru_cache
+def _descriptor_index() -> Dict[str, Model]:
+    index = {}
     for m in all_registered_models():
-        descriptors = [
-            m.descriptor(shorten_default_variant=False),
-            m.descriptor(shorten_default_variant=True),
-        ]
-        if descriptor in descriptors:
-            return m
-    return None
+        # setdefault keeps the first registered model for a descriptor, as the
+        # linear scan this replaces did
+        index.setdefault(m.descriptor(shorten_default_variant=False), m)
+        index.setdefault(m.descriptor(shorten_default_variant=True), m)
+    return index
 
 
 @lru_cache
-def all_registered_models() -> List[Model]:
-    return llama2_family() + llama3_family() + llama3_1_family() + safety_models()
+def all_registered_models() -> Tuple[Model, ...]:
+    return tuple(
+        llama2_family() + llama3_family() + llama3_1_family() + safety_models()
+    )
+
 
+def get_models_by_family(family: ModelFamily) -> Tuple[Model, ...]:
+    """Models of a single family, without building the rest of the registry."""
+    return tuple(_FAMILY_BUILDERS[family]())
 
+
+# Shared by every registered model, which SamplingParams being frozen makes safe.
+@lru_cache
 def recommended_sampling_params() -> SamplingParams:
     return SamplingParams(
         strategy=SamplingStrategy.top_p,
@@ -45,6 +139,9 @@ def recommended_sampling_params() -> SamplingParams:
     )
 
 
+# The model lists below are built once and shared between callers, which must not
+# mutate them.
+@lru_cache
 def llama2_family() -> List[Model]:
     return [
         *llama2_base_models(),
@@ -52,6 +149,7 @@ def llama2_family() -> List[Model]:
     ]
 
 
+@lru_cache
 def llama3_family() -> List[Model]:
     return [
         *llama3_base_models(),
@@ -59,6 +157,7 @@ def llama3_family() -> List[Model]:
     ]
 
 
+@lru_cache
 def llama3_1_family() -> List[Model]:
     return [
         *llama3_1_base_models(),
@@ -66,6 +165,7 @@ def llama3_1_family() -> List[Model]:
     ]
 
 
+@lru_cache
 def llama2_base_models() -> List[Model]:
     return [
         Model(
@@ -74,18 +174,7 @@ def llama2_base_models() -> List[Model]:
             description_markdown="Llama 2 7b model",
             huggingface_repo="meta-llama/Llama-2-7b",
             recommended_sampling_params=recommended_sampling_params(),
-            model_args={
-                "dim": 4096,
-                "n_layers": 32,
-                "n_heads": 32,
-                "n_kv_heads": 8,
-                "vocab_size": LLAMA2_VOCAB_SIZE,
-                "ffn_dim_multiplier": 1.3,
-                "multiple_of": 256,
-                "norm_eps": 1e-05,
-                "rope_theta": 500000.0,
-                "use_scaled_rope": False,
-            },
+            model_args=_LLAMA2_7B_ARGS,
             pth_file_count=1,
         ),
         Model(
@@ -94,18 +183,7 @@ def llama2_base_models() -> List[Model]:
             description_markdown="Llama 2 13b model",
             huggingface_repo="meta-llama/Llama-2-13b",
             recommended_sampling_params=recommended_sampling_params(),
-            model_args={
-                "dim": 5120,
-                "n_layers": 40,
-                "n_heads": 40,
-                "n_kv_heads": 8,
-                "vocab_size": LLAMA2_VOCAB_SIZE,
-                "ffn_dim_multiplier": 1.3,
-                "multiple_of": 256,
-                "norm_eps": 1e-05,
-                "rope_theta": 500000.0,
-                "use_scaled_rope": False,
-            },
+            model_args=_LLAMA2_13B_ARGS,
             pth_file_count=1,
         ),
         Model(
@@ -114,23 +192,13 @@ def llama2_base_models() -> List[Model]:
             description_markdown="Llama 2 70b model",
             huggingface_repo="meta-llama/Llama-2-70b",
             recommended_sampling_params=recommended_sampling_params(),
-            model_args={
-                "dim": 8192,
-                "n_layers": 80,
-                "n_heads": 64,
-                "n_kv_heads": 8,
-                "vocab_size": LLAMA2_VOCAB_SIZE,
-                "ffn_dim_multiplier": 1.3,
-                "multiple_of": 4096,
-                "norm_eps": 1e-05,
-                "rope_theta": 500000.0,
-                "use_scaled_rope": False,
-            },
+            model_args=_LLAMA2_70B_ARGS,
             pth_file_count=8,
         ),
     ]
 
 
+@lru_cache
 def llama3_base_models() -> List[Model]:
     return [
         Model(
@@ -139,18 +207,7 @@ def llama3_base_models() -> List[Model]:
             description_markdown="Llama 3 8b model",
             huggingface_repo="meta-llama/Meta-Llama-3-8B",
             recommended_sampling_params=recommended_sampling_params(),
-            model_args={
-                "dim": 4096,
-                "n_layers": 32,
-                "n_heads": 32,
-                "n_kv_heads": 8,
-                "vocab_size": LLAMA3_VOCAB_SIZE,
-                "ffn_dim_multiplier": 1.3,
-                "multiple_of": 1024,
-                "norm_eps": 1e-05,
-                "rope_theta": 500000.0,
-                "use_scaled_rope": False,
-            },
+            model_args=_LLAMA3_8B_ARGS,
             pth_file_count=1,
         ),
         Model(
@@ -159,23 +216,13 @@ def llama3_base_models() -> List[Model]:
             description_markdown="Llama 3 70b model",
             huggingface_repo="meta-llama/Meta-Llama-3-70B",
             recommended_sampling_params=recommended_sampling_params(),
-            model_args={
-                "dim": 8192,
-                "n_layers": 80,
-                "n_heads": 64,
-                "n_kv_heads": 8,
-                "vocab_size": LLAMA3_VOCAB_SIZE,
-                "ffn_dim_multiplier": 1.3,
-                "multiple_of": 4096,
-                "norm_eps": 1e-05,
-                "rope_theta": 500000.0,
-                "use_scaled_rope": False,
-            },
+            model_args=_LLAMA3_70B_ARGS,
             pth_file_count=8,
         ),
     ]
 
 
+@lru_cache
 def llama3_1_base_models() -> List[Model]:
     return [
         Model(
@@ -184,18 +231,7 @@ def llama3_1_base_models() -> List[Model]:
             description_markdown="Llama 3.1 8b model",
             huggingface_repo="meta-llama/Meta-Llama-3.1-8B",
             recommended_sampling_params=recommended_sampling_params(),
-            model_args={
-                "dim": 4096,
-                "n_layers": 32,
-                "n_heads": 32,
-                "n_kv_heads": 8,
-                "vocab_size": LLAMA3_VOCAB_SIZE,
-                "ffn_dim_multiplier": 1.3,
-                "multiple_of": 1024,
-                "norm_eps": 1e-05,
-                "rope_theta": 500000.0,
-                "use_scaled_rope": True,
-            },
+            model_args=_LLAMA3_1_8B_ARGS,
             pth_file_count=1,
         ),
         Model(
@@ -204,18 +240,7 @@ def llama3_1_base_models() -> List[Model]:
             description_markdown="Llama 3.1 70b model",
             huggingface_repo="meta-llama/Meta-Llama-3.1-70B",
             recommended_sampling_params=recommended_sampling_params(),
-            model_args={
-                "dim": 8192,
-                "n_layers": 80,
-                "n_heads": 64,
-                "n_kv_heads": 8,
-                "vocab_size": LLAMA3_VOCAB_SIZE,
-                "ffn_dim_multiplier": 1.3,
-                "multiple_of": 4096,
-                "norm_eps": 1e-05,
-                "rope_theta": 500000.0,
-                "use_scaled_rope": True,
-            },
+            model_args=_LLAMA3_1_70B_ARGS,
             pth_file_count=8,
         ),
         Model(
@@ -224,18 +249,7 @@ def llama3_1_base_models() -> List[Model]:
             description_markdown="Llama 3.1 405b model (BF16 weights)",
             huggingface_repo="meta-llama/Meta-Llama-3.1-405B",
             recommended_sampling_params=recommended_sampling_params(),
-            model_args={
-                "dim": 16384,
-                "n_layers": 126,
-                "n_heads": 128,
-                "n_kv_heads": 8,
-                "vocab_size": LLAMA3_VOCAB_SIZE,
-                "ffn_dim_multiplier": 1.2,
-                "multiple_of": 4096,
-                "norm_eps": 1e-05,
-                "rope_theta": 500000.0,
-                "use_scaled_rope": True,
-            },
+            model_args=_LLAMA3_1_405B_ARGS,
             pth_file_count=8,
         ),
         Model(
@@ -245,18 +259,7 @@ def llama3_1_base_models() -> List[Model]:
             huggingface_repo="meta-llama/Meta-Llama-3.1-405B-FP8",
             quantization_format=CheckpointQuantizationFormat.fp8_mixed,
             recommended_sampling_params=recommended_sampling_params(),
-            model_args={
-                "dim": 16384,
-                "n_layers": 126,
-                "n_heads": 128,
-                "n_kv_heads": 8,
-                "vocab_size": LLAMA3_VOCAB_SIZE,
-                "ffn_dim_multiplier": 1.2,
-                "multiple_of": 4096,
-                "norm_eps": 1e-05,
-                "rope_theta": 500000.0,
-                "use_scaled_rope": True,
-            },
+            model_args=_LLAMA3_1_405B_ARGS,
             pth_file_count=8,
         ),
         Model(
@@ -265,23 +268,13 @@ def llama3_1_base_models() -> List[Model]:
             description_markdown="Llama 3.1 405b model (BF16 weights for mp16)",
             huggingface_repo="meta-llama/Meta-Llama-3.1-405B",
             recommended_sampling_params=recommended_sampling_params(),
-            model_args={
-                "dim": 16384,
-                "n_layers": 126,
-                "n_heads": 128,
-                "n_kv_heads": 16,
-                "vocab_size": LLAMA3_VOCAB_SIZE,
-                "ffn_dim_multiplier": 1.2,
-                "multiple_of": 4096,
-                "norm_eps": 1e-05,
-                "rope_theta": 500000.0,
-                "use_scaled_rope": True,
-            },
+            model_args=_LLAMA3_1_405B_MP16_ARGS,
             pth_file_count=16,
         ),
     ]
 
 
+@lru_cache
 def llama2_instruct_models() -> List[Model]:
     return [
         Model(
@@ -290,18 +283,7 @@ def llama2_instruct_models() -> List[Model]:
             description_markdown="Llama 2 7b chat model",
             huggingface_repo="meta-llama/Llama-2-7b-chat",
             recommended_sampling_params=recommended_sampling_params(),
-            model_args={
-                "dim": 4096,
-                "n_layers": 32,
-                "n_heads": 32,
-                "n_kv_heads": 8,
-                "vocab_size": LLAMA2_VOCAB_SIZE,
-                "ffn_dim_multiplier": 1.3,
-                "multiple_of": 256,
-                "norm_eps": 1e-05,
-                "rope_theta": 500000.0,
-                "use_scaled_rope": False,
-            },
+            model_args=_LLAMA2_7B_ARGS,
             pth_file_count=1,
         ),
         Model(
@@ -310,18 +292,7 @@ def llama2_instruct_models() -> List[Model]:
             description_markdown="Llama 2 13b chat model",
             huggingface_repo="meta-llama/Llama-2-13b-chat",
             recommended_sampling_params=recommended_sampling_params(),
-            model_args={
-                "dim": 5120,
-                "n_layers": 40,
-                "n_heads": 40,
-                "n_kv_heads": 8,
-                "vocab_size": LLAMA2_VOCAB_SIZE,
-                "ffn_dim_multiplier": 1.3,
-                "multiple_of": 256,
-                "norm_eps": 1e-05,
-                "rope_theta": 500000.0,
-                "use_scaled_rope": False,
-            },
+            model_args=_LLAMA2_13B_ARGS,
             pth_file_count=1,
         ),
         Model(
@@ -330,23 +301,13 @@ def llama2_instruct_models() -> List[Model]:
             description_markdown="Llama 2 70b chat model",
             huggingface_repo="meta-llama/Llama-2-70b-chat",
             recommended_sampling_params=recommended_sampling_params(),
-            model_args={
-                "dim": 8192,
-                "n_layers": 80,
-                "n_heads": 64,
-                "n_kv_heads": 8,
-                "vocab_size": LLAMA2_VOCAB_SIZE,
-                "ffn_dim_multiplier": 1.3,
-                "multiple_of": 256,
-                "norm_eps": 1e-05,
-                "rope_theta": 500000.0,
-                "use_scaled_rope": False,
-            },
+            model_args=_LLAMA2_70B_CHAT_ARGS,
             pth_file_count=8,
         ),
     ]
 
 
+@lru_cache
 def llama3_instruct_models() -> List[Model]:
     return [
         Model(
@@ -355,18 +316,7 @@ def llama3_instruct_models() -> List[Model]:
             description_markdown="Llama 3 8b instruct model",
             huggingface_repo="meta-llama/Meta-Llama-3-8B-Instruct",
             recommended_sampling_params=recommended_sampling_params(),
-            model_args={
-                "dim": 4096,
-                "n_layers": 32,
-                "n_heads": 32,
-                "n_kv_heads": 8,
-                "vocab_size": LLAMA3_VOCAB_SIZE,
-                "ffn_dim_multiplier": 1.3,
-                "multiple_of": 1024,
-                "norm_eps": 1e-05,
-                "rope_theta": 500000.0,
-                "use_scaled_rope": False,
-            },
+            model_args=_LLAMA3_8B_ARGS,
             pth_file_count=1,
         ),
         Model(
@@ -375,23 +325,13 @@ def llama3_instruct_models() -> List[Model]:
             description_markdown="Llama 3 70b instruct model",
             huggingface_repo="meta-llama/Meta-Llama-3-70B-Instruct",
             recommended_sampling_params=recommended_sampling_params(),
-            model_args={
-                "dim": 8192,
-                "n_layers": 80,
-                "n_heads": 64,
-                "n_kv_heads": 8,
-                "vocab_size": LLAMA3_VOCAB_SIZE,
-                "ffn_dim_multiplier": 1.3,
-                "multiple_of": 4096,
-                "norm_eps": 1e-05,
-                "rope_theta": 500000.0,
-                "use_scaled_rope": False,
-            },
+            model_args=_LLAMA3_70B_ARGS,
             pth_file_count=8,
         ),
     ]
 
 
+@lru_cache
 def llama3_1_instruct_models() -> List[Model]:
     return [
         Model(
@@ -400,18 +340,7 @@ def llama3_1_instruct_models() -> List[Model]:
             description_markdown="Llama 3.1 8b instruct model",
             huggingface_repo="meta-llama/Meta-Llama-3.1-8B-Instruct",
             recommended_sampling_params=recommended_sampling_params(),
-            model_args={
-                "dim": 4096,
-                "n_layers": 32,
-                "n_heads": 32,
-                "n_kv_heads": 8,
-                "vocab_size": LLAMA3_VOCAB_SIZE,
-                "ffn_dim_multiplier": 1.3,
-                "multiple_of": 1024,
-                "norm_eps": 1e-05,
-                "rope_theta": 500000.0,
-                "use_scaled_rope": True,
-            },
+            model_args=_LLAMA3_1_8B_ARGS,
             pth_file_count=1,
         ),
         Model(
@@ -420,18 +349,7 @@ def llama3_1_instruct_models() -> List[Model]:
             description_markdown="Llama 3.1 70b instruct model",
             huggingface_repo="meta-llama/Meta-Llama-3.1-70B-Instruct",
             recommended_sampling_params=recommended_sampling_params(),
-            model_args={
-                "dim": 8192,
-                "n_layers": 80,
-                "n_heads": 64,
-                "n_kv_heads": 8,
-                "vocab_size": LLAMA3_VOCAB_SIZE,
-                "ffn_dim_multiplier": 1.3,
-                "multiple_of": 4096,
-                "norm_eps": 1e-05,
-                "rope_theta": 500000.0,
-                "use_scaled_rope": True,
-            },
+            model_args=_LLAMA3_1_70B_ARGS,
             pth_file_count=8,
         ),
         Model(
@@ -440,18 +358,7 @@ def llama3_1_instruct_models() -> List[Model]:
             description_markdown="Llama 3.1 405b instruct model (BF16 weights)",
             huggingface_repo="meta-llama/Meta-Llama-3.1-405B-Instruct",
             recommended_sampling_params=recommended_sampling_params(),
-            model_args={
-                "dim": 16384,
-                "n_layers": 126,
-                "n_heads": 128,
-                "n_kv_heads": 8,
-                "vocab_size": LLAMA3_VOCAB_SIZE,
-                "ffn_dim_multiplier": 1.2,
-                "multiple_of": 4096,
-                "norm_eps": 1e-05,
-                "rope_theta": 500000.0,
-                "use_scaled_rope": True,
-            },
+            model_args=_LLAMA3_1_405B_ARGS,
             pth_file_count=8,
         ),
         Model(
@@ -461,18 +368,7 @@ def llama3_1_instruct_models() -> List[Model]:
             huggingface_repo="meta-llama/Meta-Llama-3.1-405B-Instruct-FP8",
             quantization_format=CheckpointQuantizationFormat.fp8_mixed,
             recommended_sampling_params=recommended_sampling_params(),
-            model_args={
-                "dim": 16384,
-                "n_layers": 126,
-                "n_heads": 128,
-                "n_kv_heads": 8,
-                "vocab_size": LLAMA3_VOCAB_SIZE,
-                "ffn_dim_multiplier": 1.2,
-                "multiple_of": 4096,
-                "norm_eps": 1e-05,
-                "rope_theta": 500000.0,
-                "use_scaled_rope": True,
-            },
+            model_args=_LLAMA3_1_405B_ARGS,
             pth_file_count=8,
         ),
         Model(
@@ -481,18 +377,7 @@ def llama3_1_instruct_models() -> List[Model]:
             description_markdown="Llama 3.1 405b instruct model (BF16 weights for mp16)",
             huggingface_repo="meta-llama/Meta-Llama-3.1-405B-Instruct",
             recommended_sampling_params=recommended_sampling_params(),
-            model_args={
-                "dim": 16384,
-                "n_layers": 126,
-                "n_heads": 128,
-                "n_kv_heads": 16,
-                "vocab_size": LLAMA3_VOCAB_SIZE,
-                "ffn_dim_multiplier": 1.2,
-                "multiple_of": 4096,
-                "norm_eps": 1e-05,
-                "rope_theta": 500000.0,
-                "use_scaled_rope": True,
-            },
+            model_args=_LLAMA3_1_405B_MP16_ARGS,
             pth_file_count=16,
         ),
     ]
@@ -506,18 +391,7 @@ def safety_models() -> List[Model]:
             is_default_variant=True,
             description_markdown="Llama Guard v3 8b system safety model",
             huggingface_repo="meta-llama/Llama-Guard-3-8B",
-            model_args={
-                "dim": 4096,
-                "ffn_dim_multiplier": 1.3,
-                "multiple_of": 1024,
-                "n_heads": 32,
-                "n_kv_heads": 8,
-                "n_layers": 32,
-                "norm_eps": 1e-05,
-                "rope_theta": 500000.0,
-                "use_scaled_rope": False,
-                "vocab_size": LLAMA3_VOCAB_SIZE,
-            },
+            model_args=_LLAMA3_8B_ARGS,
             pth_file_count=1,
         ),
         Model(
@@ -526,18 +400,7 @@ def safety_models() -> List[Model]:
             description_markdown="Llama Guard v3 8b system safety model",
             huggingface_repo="meta-llama/Llama-Guard-3-8B-INT8",
             quantization_format=CheckpointQuantizationFormat.int8,
-            model_args={
-                "dim": 4096,
-                "ffn_dim_multiplier": 1.3,
-                "multiple_of": 1024,
-                "n_heads": 32,
-                "n_kv_heads": 8,
-                "n_layers": 32,
-                "norm_eps": 1e-05,
-                "rope_theta": 500000.0,
-                "use_scaled_rope": False,
-                "vocab_size": 128256,
-            },
+            model_args=_LLAMA3_8B_ARGS,
             pth_file_count=1,
         ),
         Model(
@@ -553,116 +416,150 @@ def safety_models() -> List[Model]:
             is_default_variant=True,
             description_markdown="Llama Guard v2 8b system safety model",
             huggingface_repo="meta-llama/Meta-Llama-Guard-2-8B",
-            model_args={
-                "dim": 4096,
-                "n_layers": 32,
-                "n_heads": 32,
-                "n_kv_heads": 8,
-                "vocab_size": LLAMA2_VOCAB_SIZE,
-                "ffn_dim_multiplier": 1.3,
-                "multiple_of": 256,
-                "norm_eps": 1e-05,
-                "rope_theta": 500000.0,
-                "use_scaled_rope": False,
-            },
+            model_args=_LLAMA2_7B_ARGS,
             pth_file_count=1,
         ),
     ]
 
 
-@dataclass
+_FAMILY_BUILDERS = {
+    ModelFamily.llama2: llama2_family,
+    ModelFamily.llama3: llama3_family,
+    ModelFamily.llama3_1: llama3_1_family,
+    ModelFamily.safety: safety_models,
+}
+
+
+@dataclass(slots=True)
 class LlamaDownloadInfo:
     folder: str
-    files: List[str]
+    files: Tuple[str, ...]
     pth_size: int
 
 
+# Download folders of the checkpoints that are not named after their Hugging Face
+# repo, keyed by (core_model_id, pth_file_count, quantization_format)
+_FOLDER_TABLE = {
+    (CoreModelId.meta_llama3_1_405b, 16, CheckpointQuantizationFormat.bf16): (
+        "Meta-Llama-3.1-405B-MP16"
+    ),
+    (CoreModelId.meta_llama3_1_405b, 8, CheckpointQuantizationFormat.fp8_mixed): (
+        "Meta-Llama-3.1-405B"
+    ),
+    (CoreModelId.meta_llama3_1_405b, 8, CheckpointQuantizationFormat.bf16): (
+        "Meta-Llama-3.1-405B-MP8"
+    ),
+    (CoreModelId.meta_llama3_1_405b_instruct, 16, CheckpointQuantizationFormat.bf16): (
+        "Meta-Llama-3.1-405B-Instruct-MP16"
+    ),
+    (
+        CoreModelId.meta_llama3_1_405b_instruct,
+        8,
+        CheckpointQuantizationFormat.fp8_mixed,
+    ): "Meta-Llama-3.1-405B-Instruct",
+    (CoreModelId.meta_llama3_1_405b_instruct, 8, CheckpointQuantizationFormat.bf16): (
+        "Meta-Llama-3.1-405B-Instruct-MP8"
+    ),
+    (CoreModelId.llama_guard_3_8b, 1, CheckpointQuantizationFormat.int8): (
+        "Meta-Llama-Guard-3-8B-INT8-HF"
+    ),
+    (CoreModelId.llama_guard_3_8b, 1, CheckpointQuantizationFormat.bf16): (
+        "Meta-Llama-Guard-3-8B"
+    ),
+    (CoreModelId.prompt_guard_86m, 1, CheckpointQuantizationFormat.bf16): (
+        "Prompt-Guard"
+    ),
+    (CoreModelId.llama_guard_2_8b, 1, CheckpointQuantizationFormat.bf16): (
+        "llama-guard-2"
+    ),
+}
+
+
+@lru_cache
+def _huggingface_folder(huggingface_repo: str) -> str:
+    folder = huggingface_repo.split("/")[-1]
+    if "Llama-2" in folder:
+        folder = folder.lower()
+    return folder
+
+
+# Files of the checkpoints that are distributed in Hugging Face format
+_LLAMA_GUARD_3_INT8_FILES = (
+    "generation_config.json",
+    "model-00001-of-00002.safetensors",
+    "model-00002-of-00002.safetensors",
+    "special_tokens_map.json",
+    "tokenizer.json",
+    "tokenizer_config.json",
+    "model.safetensors.index.json",
+)
+_PROMPT_GUARD_FILES = (
+    "model.safetensors",
+    "special_tokens_map.json",
+    "tokenizer.json",
+    "tokenizer_config.json",
+)
+
+
 def llama_meta_net_info(model: Model) -> LlamaDownloadInfo:
     """Information needed to download model from llamameta.net"""
 
-    pth_count = model.pth_file_count
-    if model.core_model_id == CoreModelId.meta_llama3_1_405b:
-        if pth_count == 16:
-            folder = "Meta-Llama-3.1-405B-MP16"
-        elif model.quantization_format == CheckpointQuantizationFormat.fp8_mixed:
-            folder = "Meta-Llama-3.1-405B"
-        else:
-            folder = "Meta-Llama-3.1-405B-MP8"
-    elif model.core_model_id == CoreModelId.meta_llama3_1_405b_instruct:
-        if pth_count == 16:
-            folder = "Meta-Llama-3.1-405B-Instruct-MP16"
-        elif model.quantization_format == CheckpointQuantizationFormat.fp8_mixed:
-            folder = "Meta-Llama-3.1-405B-Instruct"
-        else:
-            folder = "Meta-Llama-3.1-405B-Instruct-MP8"
-    elif model.core_model_id == CoreModelId.llama_guard_3_8b:
-        if model.quantization_format == CheckpointQuantizationFormat.int8:
-            folder = "Meta-Llama-Guard-3-8B-INT8-HF"
-        else:
-            folder = "Meta-Llama-Guard-3-8B"
-    elif model.core_model_id == CoreModelId.prompt_guard_86m:
-        folder = "Prompt-Guard"
-    elif model.core_model_id == CoreModelId.llama_guard_2_8b:
-        folder = "llama-guard-2"
-    else:
-        folder = model.huggingface_repo.split("/")[-1]
-        if "Llama-2" in folder:
-            folder = folder.lower()
-
-    files = ["checklist.chk"]
-    if (
-        model.core_model_id == CoreModelId.llama_guard_3_8b
-        and model.quantization_format == CheckpointQuantizationFormat.int8
-    ):
-        files.extend(
-            [
-                "generation_config.json",
-                "model-00001-of-00002.safetensors",
-                "model-00002-of-00002.safetensors",
-                "special_tokens_map.json",
-                "tokenizer.json",
-                "tokenizer_config.json",
-                "model.safetensors.index.json",
-            ]
-        )
-    elif model.core_model_id == CoreModelId.prompt_guard_86m:
-        files.extend(
-            [
-                "model.safetensors",
-                "special_tokens_map.json",
-                "tokenizer.json",
-                "tokenizer_config.json",
-            ]
-        )
-    else:
-        files.extend(
-            [
-                "tokenizer.model",
-                "params.json",
-            ]
-        )
-        if model.quantization_format == CheckpointQuantizationFormat.fp8_mixed:
-            files.extend([f"fp8_scales_{i}.pt" for i in range(pth_count)])
-        files.extend([f"consolidated.{i:02d}.pth" for i in range(pth_count)])
+    folder = _FOLDER_TABLE.get(
+        (model.core_model_id, model.pth_file_count, model.quantization_format)
+    )
+    if folder is None:
+        folder = _huggingface_folder(model.huggingface_repo)
 
     return LlamaDownloadInfo(
         folder=folder,
-        files=files,
+        files=_files_for(
+            model.core_model_id, model.quantization_format, model.pth_file_count
+        ),
         pth_size=llama_meta_pth_size(model),
     )
 
 
-# Sadness because Cloudfront rejects our HEAD requests to find Content-Length
-def llama_meta_pth_size(model: Model) -> int:
-    if model.core_model_id not in (
+# Variants with the same id, format and shard count share one file list
+@lru_cache
+def _files_for(
+    core_model_id: CoreModelId,
+    quantization_format: CheckpointQuantizationFormat,
+    pth_count: int,
+) -> Tuple[str, ...]:
+    files = ["checklist.chk"]
+    if (
+        core_model_id == CoreModelId.llama_guard_3_8b
+        and quantization_format == CheckpointQuantizationFormat.int8
+    ):
+        files += _LLAMA_GUARD_3_INT8_FILES
+    elif core_model_id == CoreModelId.prompt_guard_86m:
+        files += _PROMPT_GUARD_FILES
+    else:
+        files += ["tokenizer.model", "params.json"]
+        if quantization_format == CheckpointQuantizationFormat.fp8_mixed:
+            files += [f"fp8_scales_{i}.pt" for i in range(pth_count)]
+        files += [f"consolidated.{i:02d}.pth" for i in range(pth_count)]
+    return tuple(files)
+
+
+# Sadness because Cloudfront rejects our HEAD requests to find Content-Length.
+# Keyed by (core_model_id, pth_file_count, quantization_format); checkpoints not
+# listed here report a size of 0.
+_PTH_SIZES = {
+    (core_model_id, pth_file_count, quantization_format): size
+    for core_model_id in (
         CoreModelId.meta_llama3_1_405b,
         CoreModelId.meta_llama3_1_405b_instruct,
-    ):
-        return 0
+    )
+    for pth_file_count, quantization_format, size in (
+        (16, CheckpointQuantizationFormat.bf16, 51268302389),
+        (8, CheckpointQuantizationFormat.fp8_mixed, 60903742309),
+        (8, CheckpointQuantizationFormat.bf16, 101470976045),
+    )
+}
 
-    if model.pth_file_count == 16:
-        return 51268302389
-    elif model.quantization_format == CheckpointQuantizationFormat.fp8_mixed:
-        return 60903742309
-    else:
-        return 101470976045
+
+def llama_meta_pth_size(model: Model) -> int:
+    return _PTH_SIZES.get(
+        (model.core_model_id, model.pth_file_count, model.quantization_format), 0
+    )
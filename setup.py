@@ -16,8 +16,16 @@ from setuptools import setup
 
 def read_requirements():
     with open("requirements.txt") as fp:
-        content = fp.readlines()
-    return [line.strip() for line in content if not line.startswith("#")]
+        return [
+            line.strip()
+            for line in fp
+            if line.strip() and not line.lstrip().startswith("#")
+        ]
+
+
+def read_readme():
+    with open("README.md", encoding="utf-8") as fp:
+        return fp.read()
 
 
 setup(
@@ -26,7 +34,7 @@ setup(
     author="Meta Llama",
     author_email="llama-oss@meta.com",
     description="Llama models",
-    long_description=open("README.md").read(),
+    long_description=read_readme(),
     long_description_content_type="text/markdown",
     url="https://github.com/meta-llama/llama-models",
     package_dir={"llama_models": "models"},